@@ -1,30 +1,55 @@
 from elasticsearch import Elasticsearch
 import datetime
 import json
+import math
+from utilities.sketch import sketch_from_percentiles, merge_sketches
+from utilities.records import ContainerMetrics, ContainerMetricsList, CONTAINER_ID_JSON_NAME
 
 DEFAULT_APDEX_T = 0.5  # seconds
+DEFAULT_SAMPLING_PROBABILITY = 0.1
+CONFIDENCE_Z = 1.96  # ~95% confidence bounds for the approximate mode
+LATENCY_PERCENTS = [1, 5, 10, 25, 50, 75, 90, 95, 99, 99.9]  # used to rebuild a mergeable latency sketch per container
 
 # These are the values we need in @plugin_specific_extra_args
 # "elastic.URL", "elastic.USER", "elastic.PASSWORD", "elastic.APPS", "elastic.APDEX_T"
+# Optional: "elastic.APPROXIMATE" (true/false), "elastic.SAMPLING_PROBABILITY" and "elastic.EXACT_ENDPOINTS" (true/false)
+# (the last two are used only when APPROXIMATE)
 def compute_metrics(plugin_specific_extra_args, start_time, end_time):
     base_url = plugin_specific_extra_args.get("%s.URL" % __name__, "")
     user = plugin_specific_extra_args.get("%s.USER" % __name__, "")
     password = plugin_specific_extra_args.get("%s.PASSWORD" % __name__, "")
     app_names = plugin_specific_extra_args.get("%s.APPS" % __name__, "")
     apdex_t = plugin_specific_extra_args.get("%s.APDEX_T" % __name__, DEFAULT_APDEX_T)
+    approximate = plugin_specific_extra_args.get("%s.APPROXIMATE" % __name__, False)
+    exact_endpoints = plugin_specific_extra_args.get("%s.EXACT_ENDPOINTS" % __name__, False)
+    sampling_probability = float(plugin_specific_extra_args.get("%s.SAMPLING_PROBABILITY" % __name__, DEFAULT_SAMPLING_PROBABILITY))
     if len(app_names) == 0:
         raise ValueError("No Apps found under the parameters provided: %s" % app_names)
-    result = []
+    if approximate and not (0.0 < sampling_probability <= 0.5 or sampling_probability == 1.0):
+        raise ValueError("%s.SAMPLING_PROBABILITY must be in (0, 0.5] or exactly 1, got %s" % (__name__, sampling_probability))
+    result = ContainerMetricsList()
     es = Elasticsearch([base_url], http_auth=(user, password))
     performance_search = es.search(index="apm-*", body=_get_cpu_ram_performance_query_as_dict(start_time, end_time, app_names))
     result.extend(_extract_memory_and_cpu_usage_from_charts_data(performance_search))
 
-    metrics_search = es.search(index="apm-*", body=_get_tpm_epm_apdex_query_as_dict(start_time, end_time, app_names, apdex_t))
     interval_in_minutes = (end_time - start_time).seconds / 60
-    tpm_data = _extract_tpm_from_metrics_search(metrics_search, interval_in_minutes)
+    if approximate:
+        metrics_search = es.search(index="apm-*", body=_get_sampled_tpm_epm_apdex_query_as_dict(start_time, end_time, app_names, apdex_t, sampling_probability, exact_endpoints))
+        endpoints_per_container = _extract_endpoints_from_sampled_metrics_search(metrics_search)
+        tpm_data = _extract_tpm_from_sampled_metrics_search(metrics_search, endpoints_per_container, interval_in_minutes, sampling_probability)
+    else:
+        metrics_search = es.search(index="apm-*", body=_get_tpm_epm_apdex_query_as_dict(start_time, end_time, app_names, apdex_t))
+        tpm_data = _extract_tpm_from_metrics_search(metrics_search, interval_in_minutes)
 
     for service_info in result:
-        tpm_data_for_container = tpm_data [service_info["_container_id"]]
+        if approximate and service_info.id not in tpm_data:
+            # low traffic containers may have no documents at all in the sample
+            tpm_data_for_container = _sampled_container_estimate(service_info.id, service_info["_appname"],
+                                                                 endpoints_per_container.get(service_info.id, 0),
+                                                                 0, 0, 0, 0, 0, None, interval_in_minutes, sampling_probability)
+            tpm_data_for_container["apdex"] = _apdex_for_unsampled_container(tpm_data, service_info["_appname"])
+        else:
+            tpm_data_for_container = tpm_data [service_info.id]
         service_info.update(tpm_data_for_container)
     return result
 
@@ -40,25 +65,125 @@ def _extract_tpm_from_metrics_search(metrics_search, interval_in_minutes):
             trans_id_count = container_info_dict['trans_id_count']['value']
             tpm = trans_id_count / interval_in_minutes
             #trans_duration_avg_us = container_info_dict['trans_duration_avg_us']['value']
+            latency = _latency_sketch_from_percentiles(container_info_dict['trans_duration_percentiles'], trans_id_count)
+            if apdex_avg is not None:
+                latency.add_apdex(apdex_avg * trans_id_count, trans_id_count)
             container_id = container_info_dict["key"]
             result[container_id] = {"endpoints": endpoints_count,
                            "apdex": apdex_avg,
                            "rpm": float(tpm),
                            "epm": float(epm),
+                           "_latency": latency,
                            "_container_id": container_id,
                            "_appname": service_name}
 
     return result
 
 
+def _extract_tpm_from_sampled_metrics_search(metrics_search, endpoints_per_container, interval_in_minutes, sampling_probability):
+    result = {}
+    for service_ínfo_dict in metrics_search["aggregations"]["sample"]["service_name"]["buckets"]:
+        for container_info_dict in service_ínfo_dict["container_id"]["buckets"]:
+            result[container_info_dict["key"]] = _sampled_container_estimate(container_info_dict["key"],
+                                                                             service_ínfo_dict['key'],
+                                                                             endpoints_per_container.get(container_info_dict["key"], 0),
+                                                                             container_info_dict['trans_count']['doc_count'],
+                                                                             container_info_dict['error_count']['doc_count'],
+                                                                             container_info_dict['apdex_satisfied']['doc_count'],
+                                                                             container_info_dict['apdex_tolerating']['doc_count'],
+                                                                             container_info_dict['apdex_measured']['doc_count'],
+                                                                             container_info_dict['trans_duration_percentiles'],
+                                                                             interval_in_minutes, sampling_probability)
+    return result
+
+
+# Endpoints counted over all documents when EXACT_ENDPOINTS asked for them, otherwise over the sample (a lower bound)
+# Missing the sample says nothing about how satisfied users are (apdex_bounds stay [0, 1]), so rather than no APDEX
+# (which the formula would count as missing) we use the traffic-weighted APDEX of the sampled containers of the
+# same app, or of all sampled containers if the app has none. Their latency sketches are left alone, so the
+# merged app and fleet APDEX do not count it twice.
+def _apdex_for_unsampled_container(tpm_data, service_name):
+    sampled_latencies = [container_data["_latency"] for container_data in tpm_data.values()]
+    same_app_latencies = [container_data["_latency"] for container_data in tpm_data.values()
+                          if container_data["_appname"] == service_name]
+    apdex = merge_sketches(same_app_latencies).apdex()
+    if apdex is None:
+        apdex = merge_sketches(sampled_latencies).apdex()
+    return apdex
+
+
+def _extract_endpoints_from_sampled_metrics_search(metrics_search):
+    result = {}
+    if "endpoints" in metrics_search["aggregations"]:
+        service_buckets = metrics_search["aggregations"]["endpoints"]["buckets"]
+    else:
+        service_buckets = metrics_search["aggregations"]["sample"]["service_name"]["buckets"]
+    for service_ínfo_dict in service_buckets:
+        for container_info_dict in service_ínfo_dict["container_id"]["buckets"]:
+            result[container_info_dict["key"]] = container_info_dict['trans_name_count']['value']
+    return result
+
+
+def _sampled_container_estimate(container_id, service_name, endpoints_count, trans_count, error_count, satisfied,
+                                tolerating, measured, percentiles_agg, interval_in_minutes, sampling_probability):
+    tpm_low, tpm_high = _count_bounds(trans_count, sampling_probability)
+    epm_low, epm_high = _count_bounds(error_count, sampling_probability)
+    apdex, apdex_low, apdex_high = _apdex_with_bounds(satisfied, tolerating, measured, sampling_probability)
+    latency = _latency_sketch_from_percentiles(percentiles_agg, trans_count)
+    latency.add_apdex(satisfied + tolerating / 2.0, measured)
+    return {"endpoints": endpoints_count,
+            "apdex": apdex,
+            "apdex_bounds": [apdex_low, apdex_high],
+            "rpm": float(trans_count / interval_in_minutes),
+            "rpm_bounds": [tpm_low / interval_in_minutes, tpm_high / interval_in_minutes],
+            "epm": float(error_count / interval_in_minutes),
+            "epm_bounds": [epm_low / interval_in_minutes, epm_high / interval_in_minutes],
+            "_latency": latency,
+            "_container_id": container_id,
+            "_appname": service_name}
+
+
+def _latency_sketch_from_percentiles(percentiles_agg, count):
+    if percentiles_agg is None:
+        return sketch_from_percentiles([], count)
+    percent_value_pairs = [(entry["key"], entry["value"] / 1000000 if entry["value"] is not None else None)
+                           for entry in percentiles_agg["values"]]
+    return sketch_from_percentiles(percent_value_pairs, count)
+
+
+# random_sampler already scales doc_count back to the full population, so each count is an estimate of N = n / p
+# where n is the number of sampled documents, binomial(N, p). We use the score interval for n (variance n(1-p)),
+# which unlike the plain normal approximation stays wide when few or no documents were sampled:
+# for n = 0 the upper bound is z^2 (1-p) / p, close to the rule of three
+def _count_bounds(estimated_count, sampling_probability):
+    sampled_count = estimated_count * sampling_probability
+    spread = CONFIDENCE_Z * CONFIDENCE_Z * (1.0 - sampling_probability)
+    center = sampled_count + spread / 2.0
+    margin = math.sqrt(spread * (sampled_count + spread / 4.0))
+    return max(0.0, center - margin) / sampling_probability, (center + margin) / sampling_probability
+
+
+# APDEX is the mean of per-transaction scores (1 satisfied, 0.5 tolerating, 0 frustrated), so we use the sample
+# variance of those scores over the n = measured * p transactions that were actually sampled
+def _apdex_with_bounds(satisfied, tolerating, measured, sampling_probability):
+    if measured <= 0:
+        return None, 0.0, 1.0
+    apdex = (satisfied + tolerating / 2.0) / measured
+    mean_of_squares = (satisfied + tolerating / 4.0) / measured
+    variance = max(0.0, mean_of_squares - apdex * apdex)
+    sampled_transactions = max(1.0, measured * sampling_probability)
+    margin = CONFIDENCE_Z * math.sqrt(variance / sampled_transactions)
+    return apdex, max(0.0, apdex - margin), min(1.0, apdex + margin)
+
+
 def _extract_memory_and_cpu_usage_from_charts_data(performance_search):
     result = []
     for service_ínfo_dict in performance_search["aggregations"]["service_name"]["buckets"]:
         for perf_by_container in service_ínfo_dict["host_name"]["buckets"]:
-            service_data = dict()
-            service_data["_container_id"] = perf_by_container["key"]
-            service_data["mem"] = perf_by_container["ram_used"]["value"]
-            service_data["cpu"] = perf_by_container["cpu_percent_max"]["value"] * 100 # equivalent to the system max in the Kibana GUI
+            service_data = ContainerMetrics(id=perf_by_container["key"], id_key=CONTAINER_ID_JSON_NAME)
+            service_data.appname = service_ínfo_dict["key"]
+            service_data.mem = perf_by_container["ram_used"]["value"]
+            service_data.cpu = perf_by_container["cpu_percent_max"]["value"] * 100 # equivalent to the system max in the Kibana GUI
             result.append(service_data)
     return result
 
@@ -71,10 +196,21 @@ def _get_cpu_ram_performance_query_as_dict (start_time, end_time, app_names):
 
 def _get_tpm_epm_apdex_query_as_dict (start_time, end_time, app_names, apdex_t):
     global QUERY_TEMPLATE_FOR_TPM_EPM
-    concrete_query = QUERY_TEMPLATE_FOR_TPM_EPM % (apdex_t, apdex_t, app_names, start_time.isoformat(), end_time.isoformat())
+    concrete_query = QUERY_TEMPLATE_FOR_TPM_EPM % (json.dumps(LATENCY_PERCENTS), apdex_t, apdex_t, app_names, start_time.isoformat(), end_time.isoformat())
     return json.loads(concrete_query)
 
 
+def _get_sampled_tpm_epm_apdex_query_as_dict (start_time, end_time, app_names, apdex_t, sampling_probability, exact_endpoints):
+    global QUERY_TEMPLATE_FOR_SAMPLED_TPM_EPM, QUERY_TEMPLATE_FOR_EXACT_ENDPOINTS
+    apdex_t_us = int(float(apdex_t) * 1000000)
+    concrete_query = QUERY_TEMPLATE_FOR_SAMPLED_TPM_EPM % (sampling_probability, apdex_t_us, apdex_t_us, apdex_t_us * 4,
+                                                          json.dumps(LATENCY_PERCENTS), app_names, start_time.isoformat(), end_time.isoformat())
+    result = json.loads(concrete_query)
+    if exact_endpoints:
+        result["aggs"]["endpoints"] = json.loads(QUERY_TEMPLATE_FOR_EXACT_ENDPOINTS)
+    return result
+
+
 QUERY_TEMPLATE_FOR_CPU_RAM = \
     """
 {
@@ -224,12 +360,10 @@ QUERY_TEMPLATE_FOR_TPM_EPM = \
                                 "field": "transaction.duration.us"
                             }
                         },
-                        "3": {
+                        "trans_duration_percentiles": {
                             "percentiles": {
                                 "field": "transaction.duration.us",
-                                "percents": [
-                                    95
-                                ],
+                                "percents": %s,
                                 "keyed": false
                             }
                         },
@@ -352,3 +486,148 @@ QUERY_TEMPLATE_FOR_TPM_EPM = \
     }
 }
     """
+
+
+# Approximate variant of QUERY_TEMPLATE_FOR_TPM_EPM: runs over a random sample of the documents and replaces the
+# cardinality over unique ids and the per-document APDEX script with plain doc counts. Endpoints are counted on
+# the sample too, unless QUERY_TEMPLATE_FOR_EXACT_ENDPOINTS is added next to it
+QUERY_TEMPLATE_FOR_SAMPLED_TPM_EPM = \
+    """
+{
+    "aggs": {
+        "sample": {
+            "random_sampler": {
+                "probability": %s
+            },
+            "aggs": {
+                "service_name": {
+                    "terms": {
+                        "field": "service.name",
+                        "size": 1000
+                    },
+                    "aggs": {
+                        "container_id": {
+                            "terms": {
+                                "field": "container.id",
+                                "size": 999
+                            },
+                            "aggs": {
+                                "trans_count": {
+                                    "filter": {
+                                        "term": {
+                                            "processor.event": "transaction"
+                                        }
+                                    }
+                                },
+                                "error_count": {
+                                    "filter": {
+                                        "term": {
+                                            "processor.event": "error"
+                                        }
+                                    }
+                                },
+                                "apdex_measured": {
+                                    "filter": {
+                                        "exists": {
+                                            "field": "transaction.duration.us"
+                                        }
+                                    }
+                                },
+                                "apdex_satisfied": {
+                                    "filter": {
+                                        "range": {
+                                            "transaction.duration.us": {
+                                                "lte": %s
+                                            }
+                                        }
+                                    }
+                                },
+                                "apdex_tolerating": {
+                                    "filter": {
+                                        "range": {
+                                            "transaction.duration.us": {
+                                                "gt": %s,
+                                                "lte": %s
+                                            }
+                                        }
+                                    }
+                                },
+                                "trans_duration_percentiles": {
+                                    "percentiles": {
+                                        "field": "transaction.duration.us",
+                                        "percents": %s,
+                                        "keyed": false
+                                    }
+                                },
+                                "trans_name_count": {
+                                    "cardinality": {
+                                        "field": "transaction.name"
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    },
+    "size": 0,
+    "query": {
+        "bool": {
+            "filter": [
+                {
+                    "match_phrase": {
+                        "service.name": {
+                            "query": "%s"
+                        }
+                    }
+                },
+                {
+                    "match_phrase": {
+                        "transaction.type": {
+                            "query": "request"
+                        }
+                    }
+                },
+                {
+                    "range": {
+                        "@timestamp": {
+                            "format": "strict_date_optional_time",
+                            "gte": "%sZ",
+                            "lte": "%sZ"
+                        }
+                    }
+                }
+            ]
+        }
+    }
+}
+    """
+
+
+# Optional sibling of the random_sampler in QUERY_TEMPLATE_FOR_SAMPLED_TPM_EPM: counts endpoints over all documents,
+# so rarely called endpoints are not missed, at the cost of visiting every matching document again
+QUERY_TEMPLATE_FOR_EXACT_ENDPOINTS = \
+    """
+{
+    "terms": {
+        "field": "service.name",
+        "size": 1000
+    },
+    "aggs": {
+        "container_id": {
+            "terms": {
+                "field": "container.id",
+                "size": 999
+            },
+            "aggs": {
+                "trans_name_count": {
+                    "cardinality": {
+                        "field": "transaction.name"
+                    }
+                }
+            }
+        }
+    }
+}
+    """
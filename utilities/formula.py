@@ -1,3 +1,8 @@
+from utilities.records import ContainerMetrics, MISSING
+
+# We get ms_runtime_data as utilities.records.ContainerMetrics (see mswyw.compute_formula) and read their slots
+# directly. Plain dicts are still accepted, at the cost of converting them first.
+ACCEPTS_CONTAINER_METRICS = True
 
 def calc_mswyw(ms_runtime_data, formula_coefficients, overrides, default_value_for_missing_metric):
     # TODO: we still need to take into account how many "features" each microservices contributes with (value)
@@ -6,14 +11,40 @@ def calc_mswyw(ms_runtime_data, formula_coefficients, overrides, default_value_f
     # if we let the user provide LOC, it is a pain for when we are run in multiple apps mode
     total_cost = 0.0
     total_value = 0.0
-    for metrics in ms_runtime_data:
-        total_cost += formula_coefficients["mem"]* overrides.get("mem", metrics.get("mem", default_value_for_missing_metric)) + \
-                      formula_coefficients["cpu"]*overrides.get("cpu", metrics.get("cpu", default_value_for_missing_metric)) + \
-                      formula_coefficients["epm"]*overrides.get("epm", metrics.get("epm", default_value_for_missing_metric))
-        total_value += formula_coefficients["apdex"]*overrides.get("apdex", metrics.get("apdex", default_value_for_missing_metric)) + \
-                       formula_coefficients["rpm"]*overrides.get("rpm", metrics.get("rpm", default_value_for_missing_metric)) + \
-                       formula_coefficients["endpoints"]*overrides.get("endpoints", metrics.get("endpoints", default_value_for_missing_metric))
+    ms_runtime_data = [metrics if isinstance(metrics, ContainerMetrics) else ContainerMetrics.from_dict(metrics)
+                       for metrics in ms_runtime_data]
+    # Averaging APDEX per container and summing it ignores how much traffic each container took. When every
+    # container brings its latency sketch we merge them and use the traffic-weighted APDEX for each one instead.
+    merged_apdex = _merged_apdex(ms_runtime_data)
+    # the formula is linear, so we add up each metric over all containers once instead of once per container
+    total_cost += formula_coefficients["mem"]*_total("mem", [metrics.mem for metrics in ms_runtime_data], overrides, default_value_for_missing_metric) + \
+                  formula_coefficients["cpu"]*_total("cpu", [metrics.cpu for metrics in ms_runtime_data], overrides, default_value_for_missing_metric) + \
+                  formula_coefficients["epm"]*_total("epm", [metrics.epm for metrics in ms_runtime_data], overrides, default_value_for_missing_metric)
+    apdexes = [merged_apdex] * len(ms_runtime_data) if merged_apdex is not None else [metrics.apdex for metrics in ms_runtime_data]
+    total_value += formula_coefficients["apdex"]*_total("apdex", apdexes, overrides, default_value_for_missing_metric) + \
+                   formula_coefficients["rpm"]*_total("rpm", [metrics.rpm for metrics in ms_runtime_data], overrides, default_value_for_missing_metric) + \
+                   formula_coefficients["endpoints"]*_total("endpoints", [metrics.endpoints for metrics in ms_runtime_data], overrides, default_value_for_missing_metric)
     if total_cost <= 0.0:
         return 0.0
     else:
-        return formula_coefficients["total"] * (total_value / total_cost)
\ No newline at end of file
+        return formula_coefficients["total"] * (total_value / total_cost)
+
+
+# A metric the provider could not measure (never set, or None - e.g. APDEX of a container with no transactions)
+# counts as missing and gets the default value
+def _total(name, measured_values, overrides, default_value_for_missing_metric):
+    if name in overrides:
+        return overrides[name] * len(measured_values)
+    return sum(default_value_for_missing_metric if value is None or value is MISSING else value
+               for value in measured_values)
+
+
+def _merged_apdex(ms_runtime_data):
+    sketches = [metrics.latency for metrics in ms_runtime_data]
+    if len(sketches) == 0 or any(sketch is None or sketch is MISSING for sketch in sketches):
+        return None
+    # same as merge_sketches(sketches).apdex(), without merging the latency buckets we do not need here
+    apdex_count = sum(sketch.apdex_count for sketch in sketches)
+    if apdex_count <= 0:
+        return None
+    return sum(sketch.apdex_score for sketch in sketches) / apdex_count
@@ -34,6 +34,8 @@ import urllib
 import re
 from docopt import docopt
 from utilities import VERSION
+from utilities.sketch import merge_sketches
+from utilities.records import ContainerMetricsList, as_container_metrics_list, SCORE_JSON_NAME
 import importlib
 
 # Adapted: https://stackoverflow.com/questions/7160737/python-how-to-validate-a-url-in-python-malformed-or-not
@@ -44,9 +46,9 @@ DEFAULT_INTERVAL_IN_MINUTES=30
 DEFAULT_END_MINUTES_AGO=0
 DEFAULT_VALUE_FOR_MISSING_MATRIC = -1000
 
-SCORE_JSON_NAME = "mswyw-score"
 RUNTIME_DATA_JSON_NAME = "runtime-data"
 APP_RUNTIME_DATA_JSON_NAME = "app-runtime-data"
+LATENCY_JSON_NAME = "latency"
 
 def is_url(a_string):
     return URL_REGEX.match(a_string)
@@ -63,12 +65,18 @@ def params_as_dict(fqn_or_json_orjson_path):
         return json.loads(fqn_or_json_orjson_path)
 
 
+def as_json_value(an_object):
+    if hasattr(an_object, "as_dict"):
+        return an_object.as_dict()
+    raise TypeError("%s is not JSON serializable" % type(an_object).__name__)
+
+
 def compute_metrics(plugin_name_as_fqn_python_module, plugin_specific_extra_args, start_time, end_time):
     try:
         provider_module = importlib.import_module(plugin_name_as_fqn_python_module)
     except ModuleNotFoundError:
         raise ValueError("Cannot resolve %s" % plugin_name_as_fqn_python_module)
-    return provider_module.compute_metrics(plugin_specific_extra_args, start_time, end_time)
+    return as_container_metrics_list(provider_module.compute_metrics(plugin_specific_extra_args, start_time, end_time))
 
 
 def compute_formula(plugin_name_as_fqn_python_module, ms_runtime_data, formula_coefficients, overrides):
@@ -76,6 +84,8 @@ def compute_formula(plugin_name_as_fqn_python_module, ms_runtime_data, formula_c
         calc_module = importlib.import_module(plugin_name_as_fqn_python_module)
     except ModuleNotFoundError:
         raise ValueError("Cannot resolve %s" % plugin_name_as_fqn_python_module)
+    if not getattr(calc_module, "ACCEPTS_CONTAINER_METRICS", False):
+        ms_runtime_data = ms_runtime_data.as_legacy_dicts()  # plugins written against the old free-form dicts
     return calc_module.calc_mswyw(ms_runtime_data, formula_coefficients, overrides, DEFAULT_VALUE_FOR_MISSING_MATRIC)
 
 
@@ -101,7 +111,7 @@ def sanitize_coefficients(coefs):
             raise ValueError("%s is set to %s, which is not a valid number" % (name, value))
 
 
-def report_verbose(arguments, app_runtime_data, mswyw_score, sampling_end_time, sampling_start_time, script_end_time,
+def report_verbose(arguments, app_runtime_data, mswyw_score, latency, sampling_end_time, sampling_start_time, script_end_time,
                    script_start_time):
     print("\r\n====== mswyw - see https://github.com/sglebs/mswyw ==========")
     print(arguments)
@@ -112,6 +122,7 @@ def report_verbose(arguments, app_runtime_data, mswyw_score, sampling_end_time,
     print("--------------------------------------------------")
     for app_name, app_data in app_runtime_data.items():
         print("%s : %s" % (app_name, app_data[SCORE_JSON_NAME]))
+        print("Latency: %s" % app_data[LATENCY_JSON_NAME])
         for runtime_data in app_data[RUNTIME_DATA_JSON_NAME]:
             print(runtime_data)
         print("")
@@ -120,6 +131,7 @@ def report_verbose(arguments, app_runtime_data, mswyw_score, sampling_end_time,
     print("Finished: %s" % str(script_end_time))
     print("Total: %s" % str(script_end_time - script_start_time))
     print("mswyw score: %s" % str(mswyw_score))
+    print("Latency: %s" % latency)
     print("--------------------------------------------------")
 
 
@@ -142,21 +154,23 @@ def main():
         app_runtime_data = compute_score_per_app(arguments, formula_coefficients, ms_runtime_data, overrides)
         result[APP_RUNTIME_DATA_JSON_NAME] = app_runtime_data
         mswyw_score = compute_formula(arguments.get("--calcProvider"), ms_runtime_data, formula_coefficients, overrides)
+        latency = compute_latency(ms_runtime_data)
         script_end_time = datetime.datetime.now()
         result["arguments"] = arguments
         result["start-time"] = sampling_start_time.isoformat()
         result["end-time"] = sampling_end_time.isoformat()
         result["overrides"] = overrides
         result[SCORE_JSON_NAME] = mswyw_score
+        result[LATENCY_JSON_NAME] = latency
         min_result = params_as_dict(arguments.get("--minResult", 0.0))
         failed_performance = mswyw_score < min_result
         result["failed-performance"] = failed_performance
 
         if arguments.get("--verbose", False):
-            report_verbose(arguments, app_runtime_data, mswyw_score, sampling_end_time, sampling_start_time, script_end_time,
+            report_verbose(arguments, app_runtime_data, mswyw_score, latency, sampling_end_time, sampling_start_time, script_end_time,
                        script_start_time)
         else:
-            print(json.dumps(result, indent=4))
+            print(json.dumps(result, indent=4, default=as_json_value))
 
         if failed_performance:
             exit(-10)  # any non-zero value, really
@@ -167,27 +181,29 @@ def main():
 
 def compute_score_per_container(arguments, formula_coefficients, ms_runtime_data, overrides):
     for container_runtime_data in ms_runtime_data:
-        one_container_data = list()
+        one_container_data = ContainerMetricsList()
         one_container_data.append(container_runtime_data)
         mswyw_score_for_individual_container = compute_formula(arguments.get("--calcProvider"), one_container_data,
                                                                formula_coefficients, overrides)
         container_runtime_data[SCORE_JSON_NAME] = mswyw_score_for_individual_container
 
 def compute_score_per_app(arguments, formula_coefficients, ms_runtime_data, overrides):
-    app_names = [container_runtime_data["_appname"] for container_runtime_data in ms_runtime_data]
-    runtime_data_per_app = {app_name: list() for app_name in set(app_names)}
     result = dict()
-    for container_runtime_data in ms_runtime_data:
-        runtime_data_per_app[container_runtime_data["_appname"]].append(container_runtime_data)
-    for app_name, app_containers_runtime_data in runtime_data_per_app.items():
+    for app_name, app_containers_runtime_data in ms_runtime_data.by_app().items():
         mswyw_score_for_app = compute_formula(arguments.get("--calcProvider"), app_containers_runtime_data,
                                                                formula_coefficients, overrides)
         app_data = dict()
         app_data[SCORE_JSON_NAME] = mswyw_score_for_app
+        app_data[LATENCY_JSON_NAME] = compute_latency(app_containers_runtime_data)
         app_data[RUNTIME_DATA_JSON_NAME] = app_containers_runtime_data
         result[app_name]= app_data
     return result
 
 
+# App-level and fleet-level latency come from merging the per-container sketches, no extra query needed
+def compute_latency(ms_runtime_data):
+    return merge_sketches([container_runtime_data.get("_latency") for container_runtime_data in ms_runtime_data]).summary()
+
+
 if __name__ == '__main__':
     main()
@@ -5,6 +5,8 @@ from socket import error as SocketError
 import xml.etree.ElementTree as ET
 import json
 import re
+from utilities.sketch import LatencySketch
+from utilities.records import ContainerMetrics, ContainerMetricsList
 
 # Get instances: https://rpm.newrelic.com/api/explore/application_instances/list?application_id=nnnnnn
 # Metric names: https://rpm.newrelic.com/api/explore/application_instances/names?instance_id=nnnnnnnn&application_id=nnnnnnnn
@@ -23,20 +25,21 @@ def compute_metrics(plugin_specific_extra_args, start_time, end_time):
         app_ids = _get_app_ids_by_name(app_names, api_key)
     if len(app_ids) == 0:
         raise ValueError("No Apps found under the parameters provided: %s" % app_names)
-    result = []
+    result = ContainerMetricsList()
     for app_id in app_ids:
         app_instance_info = _get_app_instance_ids_and_language(app_id, api_key)
         app_instance_ids = [info[0] for info in app_instance_info]
         app_instance_languages = [info[1] for info in app_instance_info]
         app_instance_appnames = [info[2] for info in app_instance_info]
         metric_dicts = [_get_app_instance_metrics(app_id, api_key, instance_id) for instance_id in app_instance_ids]
-        for instance_id, language, app_name, metrics in zip(app_instance_ids, app_instance_languages, app_instance_appnames, metric_dicts):
+        for instance_id, language, app_name, metric_dict in zip(app_instance_ids, app_instance_languages, app_instance_appnames, metric_dicts):
+            metrics = ContainerMetrics(id=instance_id, **metric_dict)
             # we could cheat and instead of looping we could get for the 1st and assume they are all equal. just for speed.
-            metrics["endpoints"] = _get_number_of_endpoints(app_id, api_key, instance_id)
-            metrics["_id"] = instance_id
-            metrics["_lang"] = language
-            metrics["_appname"] = app_name
-        result.extend(metric_dicts)
+            metrics.endpoints = _get_number_of_endpoints(app_id, api_key, instance_id)
+            metrics.latency = _get_app_instance_latency_sketch(app_id, api_key, instance_id)
+            metrics.lang = language
+            metrics.appname = app_name
+            result.append(metrics)
     return result
 
 def _get_number_of_endpoints(app_id, api_key, instance_id):
@@ -74,6 +77,23 @@ def _get_app_instance_metrics(app_id, api_key, instance_id):
     epm = root.find(".//metrics/metric/[name='Errors/all']/timeslices/timeslice/values/errors_per_minute")
     return {"mem":int(memory_usage.text), "apdex": float(apdex.text), "cpu": float(cpu_percent.text), "rpm": float(rpm.text), "epm": float(epm.text)}
 
+# New Relic only gives us per-period averages of the response time, not the distribution of request latencies,
+# so the sketch carries just the exact Apdex satisfied/tolerating/frustrated counts (summed over the timeslices)
+# and no latency buckets: its percentiles stay None instead of passing averages off as p95/p99
+def _get_app_instance_latency_sketch(app_id, api_key, instance_id):
+    url = "https://api.newrelic.com/v2/applications/%s/instances/%s/metrics/data.xml?names[]=Apdex&values[]=s&values[]=t&values[]=f" % (app_id,instance_id)
+    newrelic_result = connect_and_get(url,api_key)
+    root = ET.fromstring(newrelic_result.content)
+    if newrelic_result.status_code != 200:
+        raise ValueError(root.find(".//title").text)
+    result = LatencySketch()
+    for timeslice in root.findall(".//metrics/metric/[name='Apdex']/timeslices/timeslice/values"):
+        satisfied = float(timeslice.find("s").text)
+        tolerating = float(timeslice.find("t").text)
+        frustrated = float(timeslice.find("f").text)
+        result.add_apdex(satisfied + tolerating / 2.0, satisfied + tolerating + frustrated)
+    return result
+
 def _get_app_ids_by_name(app_name_regex, api_key):
     url = "https://api.newrelic.com/v2/applications.xml"
     newrelic_result = connect_and_get(url, api_key)
@@ -0,0 +1,152 @@
+# Compact per-container records shared by the runtime providers, the formula and the grouping code in mswyw.py.
+#
+# Each record keeps its values in __slots__ instead of a per-instance dict, and carries a normalized id no matter
+# which key the provider used for it (New Relic: "_id", Elastic: "_container_id"). Records still behave like the
+# old free-form dicts (string keys, .get, [] assignment, update) and as_dict() gives a plain dict copy, so custom
+# --calcProvider plugins and the JSON output keep seeing the exact same keys as before, None values included.
+# Slot attributes can be read directly for speed: a slot that was never set holds MISSING.
+
+from collections.abc import MutableMapping
+
+ID_JSON_NAME = "_id"
+CONTAINER_ID_JSON_NAME = "_container_id"
+SCORE_JSON_NAME = "mswyw-score"
+
+# dict key -> slot, in the order keys are listed by the dict view
+_SLOTS_BY_KEY = {"mem": "mem",
+                 "cpu": "cpu",
+                 "epm": "epm",
+                 "epm_bounds": "epm_bounds",
+                 "rpm": "rpm",
+                 "rpm_bounds": "rpm_bounds",
+                 "apdex": "apdex",
+                 "apdex_bounds": "apdex_bounds",
+                 "endpoints": "endpoints",
+                 "_appname": "appname",
+                 "_lang": "lang",
+                 "_latency": "latency",
+                 SCORE_JSON_NAME: "score"}
+
+
+# Marks a slot that was never set, so that a key explicitly set to None still shows up in the dict view.
+# Copies and pickles resolve back to the module-level MISSING, so identity checks keep working.
+class _Missing:
+    __slots__ = ()
+
+    def __reduce__(self):
+        return "MISSING"
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+
+class ContainerMetrics(MutableMapping):
+    __slots__ = ("id", "id_key", "extras", "legacy_dict") + tuple(_SLOTS_BY_KEY.values())
+
+    def __init__(self, id=MISSING, id_key=ID_JSON_NAME, **values):
+        self.id = id
+        self.id_key = id_key
+        self.extras = None  # anything a custom provider sends that we have no slot for
+        self.legacy_dict = None  # see as_legacy_dict
+        for slot in _SLOTS_BY_KEY.values():
+            setattr(self, slot, MISSING)
+        for key, value in values.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, a_dict):
+        id_key = CONTAINER_ID_JSON_NAME if CONTAINER_ID_JSON_NAME in a_dict and ID_JSON_NAME not in a_dict else ID_JSON_NAME
+        result = cls(id_key=id_key)
+        result.update(a_dict)
+        return result
+
+    def as_dict(self):
+        if self.legacy_dict is not None:
+            return dict(self.legacy_dict)
+        return dict(self)
+
+    # The plain dict handed to --calcProvider plugins written against the old free-form dicts. It is built once and
+    # then reused for every call, and it is also what we report, so whatever a plugin stores in it shows up in the
+    # output like it used to. Values with an as_dict (the latency sketch) are replaced by it, so the dict only holds
+    # plain JSON-friendly values.
+    def as_legacy_dict(self):
+        if self.legacy_dict is None:
+            self.legacy_dict = {key: _as_plain_value(value) for key, value in self.items()}
+        return self.legacy_dict
+
+    def __getitem__(self, key):
+        slot = _SLOTS_BY_KEY.get(key)
+        if slot is not None:
+            value = getattr(self, slot)
+        elif key == self.id_key:
+            value = self.id
+        else:
+            value = self.extras.get(key, MISSING) if self.extras else MISSING
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if self.legacy_dict is not None:
+            self.legacy_dict[key] = _as_plain_value(value)
+        slot = _SLOTS_BY_KEY.get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        elif key == self.id_key:
+            self.id = value
+        else:
+            if self.extras is None:
+                self.extras = dict()
+            self.extras[key] = value
+
+    def __delitem__(self, key):
+        self[key]  # raises KeyError like a dict would
+        if self.legacy_dict is not None:
+            self.legacy_dict.pop(key, None)
+        slot = _SLOTS_BY_KEY.get(key)
+        if slot is not None:
+            setattr(self, slot, MISSING)
+        elif key == self.id_key:
+            self.id = MISSING
+        else:
+            del self.extras[key]
+
+    def __iter__(self):
+        for key, slot in _SLOTS_BY_KEY.items():
+            if getattr(self, slot) is not MISSING:
+                yield key
+        if self.id is not MISSING:
+            yield self.id_key
+        if self.extras:
+            yield from self.extras
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class ContainerMetricsList(list):
+    def by_app(self):
+        result = dict()
+        for container_metrics in self:
+            result.setdefault(container_metrics["_appname"], ContainerMetricsList()).append(container_metrics)
+        return result
+
+    def as_legacy_dicts(self):
+        return [container_metrics.as_legacy_dict() for container_metrics in self]
+
+
+def _as_plain_value(value):
+    return value.as_dict() if hasattr(value, "as_dict") else value
+
+
+# Custom runtime providers may still return plain dicts - we accept both
+def as_container_metrics_list(ms_runtime_data):
+    return ContainerMetricsList(container_metrics if isinstance(container_metrics, ContainerMetrics)
+                                else ContainerMetrics.from_dict(container_metrics)
+                                for container_metrics in ms_runtime_data)
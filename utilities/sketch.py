@@ -0,0 +1,106 @@
+# Mergeable latency distributions, so we can compute app-level and fleet-level APDEX and percentiles
+# by merging per-container sketches in memory instead of running another query at a coarser grouping.
+#
+# Latencies are kept in log-spaced buckets (HDR/DDSketch style): every value lands in a bucket whose
+# bounds are within RELATIVE_ACCURACY of it, and merging two sketches is just adding bucket counts.
+# APDEX is kept as exact counts next to the buckets, since the providers give it to us that way.
+
+import math
+
+RELATIVE_ACCURACY = 0.01
+PERCENTILES_FOR_SUMMARY = [50, 95, 99]
+
+
+class LatencySketch:
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.buckets = {}  # bucket index -> weight
+        self.zero_count = 0.0
+        self.count = 0.0
+        self.apdex_score = 0.0  # satisfied + tolerating / 2
+        self.apdex_count = 0.0
+
+    def add(self, seconds, weight=1.0):
+        if seconds is None or weight <= 0:
+            return
+        if seconds <= 0:
+            self.zero_count += weight
+        else:
+            index = int(math.ceil(math.log(seconds) / self._log_gamma))
+            self.buckets[index] = self.buckets.get(index, 0.0) + weight
+        self.count += weight
+
+    # @score is satisfied + tolerating / 2 over @count measured transactions
+    def add_apdex(self, score, count):
+        if score is None or count <= 0:
+            return
+        self.apdex_score += score
+        self.apdex_count += count
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracies: %s and %s" %
+                             (self.relative_accuracy, other.relative_accuracy))
+        for index, weight in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0.0) + weight
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.apdex_score += other.apdex_score
+        self.apdex_count += other.apdex_count
+        return self
+
+    def apdex(self):
+        if self.apdex_count <= 0:
+            return None
+        return self.apdex_score / self.apdex_count
+
+    def percentile(self, percent):
+        if self.count <= 0:
+            return None
+        rank = self.count * percent / 100.0 * (1 - 1e-9)  # tolerate float error when summing the weights
+        seen = self.zero_count
+        if seen >= rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return 2.0 * self._gamma ** index / (self._gamma + 1)
+        return 2.0 * self._gamma ** max(self.buckets) / (self._gamma + 1)
+
+    def summary(self):
+        result = {"count": self.count, "apdex": self.apdex()}
+        for percent in PERCENTILES_FOR_SUMMARY:
+            result["p%s" % percent] = self.percentile(percent)
+        return result
+
+    def as_dict(self):
+        return self.summary()
+
+    def __repr__(self):
+        return repr(self.summary())
+
+
+def merge_sketches(sketches):
+    result = LatencySketch()
+    for sketch in sketches:
+        if sketch is not None:
+            result.merge(sketch)
+    return result
+
+
+# Turns a percentiles aggregation (list of [percent, value] pairs, values in seconds) for @count observations into
+# a sketch: the mass between two consecutive percents is placed at the upper one, so the sketch reproduces the
+# original percentiles exactly and errs on the slow side in between
+def sketch_from_percentiles(percent_value_pairs, count):
+    result = LatencySketch()
+    pairs = sorted((percent, value) for percent, value in percent_value_pairs if value is not None)
+    if count <= 0 or len(pairs) == 0:
+        return result
+    previous_percent, previous_value = 0.0, pairs[0][1]
+    for percent, value in pairs:
+        result.add(value, count * (percent - previous_percent) / 100.0)
+        previous_percent, previous_value = percent, value
+    result.add(previous_value, count * (100.0 - previous_percent) / 100.0)
+    return result